@@ -5,65 +5,180 @@ Generic template for training text humanization models with PyTorch
 """
 
 import argparse
+import importlib.util
 import json
 import os
 import sys
+from dataclasses import dataclass, field, fields
+from typing import Optional, Tuple
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from torch.utils.data import Dataset, DataLoader
+from datasets import load_dataset, Features, Sequence, Value
 from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
-from transformers import Trainer, TrainingArguments
+from transformers import Trainer, TrainingArguments, DataCollatorForSeq2Seq
 import logging
 from pathlib import Path
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Narrow integer storage for the Arrow cache; token ids fit in int32 and masks in int8
+TOKENIZED_FEATURES = Features({
+    'input_ids': Sequence(Value('int32')),
+    'attention_mask': Sequence(Value('int8')),
+    'labels': Sequence(Value('int32')),
+    'length': Value('int32'),
+})
 
-class HumanizationDataset(Dataset):
-    """Dataset for text humanization pairs"""
+
+def load_humanization_dataset(
+    data_path: str,
+    tokenizer,
+    max_length: int = 512,
+    num_proc: int = None,
+    batch_size: int = 10000,
+):
+    """Load text humanization pairs as a tokenized, Arrow-backed dataset
     
-    def __init__(self, data_path: str, tokenizer, max_length: int = 512):
-        self.tokenizer = tokenizer
-        self.max_length = max_length
-        
-        # Load training data
-        with open(data_path, 'r', encoding='utf-8') as f:
-            self.data = json.load(f) if data_path.endswith('.json') else [json.loads(line) for line in f]
-        
-        logger.info(f"Loaded {len(self.data)} training examples")
+    Tokenization runs once and is cached next to the Arrow file, which is
+    memory-mapped at train time instead of being held in RAM as Python objects.
+    Padding is left to the collator so each batch only pads to its own longest sample.
+    """
+    dataset = load_dataset('json', data_files=data_path, split='train')
     
-    def __len__(self):
-        return len(self.data)
+    # Large batches keep the Rust tokenizer busy per call. Worker processes only pay off
+    # with more than one batch, and then the tokenizer's own thread pool would oversubscribe.
+    if not num_proc or num_proc <= 1 or len(dataset) <= batch_size:
+        num_proc = None
     
-    def __getitem__(self, idx):
-        item = self.data[idx]
-        original = item['input']
-        humanized = item['output']
-        
-        # Tokenize inputs and targets
-        inputs = self.tokenizer(
-            original,
-            max_length=self.max_length,
-            padding='max_length',
-            truncation=True,
-            return_tensors='pt'
-        )
-        
-        targets = self.tokenizer(
-            humanized,
-            max_length=self.max_length,
-            padding='max_length',
-            truncation=True,
-            return_tensors='pt'
+    def tokenize(batch):
+        sources = tokenizer(batch['input'], max_length=max_length, truncation=True)
+        targets = tokenizer(text_target=batch['output'], max_length=max_length, truncation=True)
+        # Keep only the columns in TOKENIZED_FEATURES (drops e.g. token_type_ids)
+        model_inputs = {
+            'input_ids': sources['input_ids'],
+            'attention_mask': sources['attention_mask'],
+        }
+        # Pad positions are ignored by the loss (ignore_index=-100), matching the collator
+        model_inputs['labels'] = [
+            [-100 if token == tokenizer.pad_token_id else token for token in ids] for ids in targets['input_ids']
+        ]
+        # Combined length lets the Trainer batch similarly sized pairs together
+        model_inputs['length'] = [
+            len(source) + len(target) for source, target in zip(model_inputs['input_ids'], model_inputs['labels'])
+        ]
+        return model_inputs
+    
+    previous_parallelism = os.environ.get('TOKENIZERS_PARALLELISM')
+    if num_proc:
+        os.environ['TOKENIZERS_PARALLELISM'] = 'false'
+    try:
+        dataset = dataset.map(
+            tokenize,
+            batched=True,
+            batch_size=batch_size,
+            num_proc=num_proc,
+            remove_columns=dataset.column_names,
+            features=TOKENIZED_FEATURES,
+            desc='Tokenizing',
         )
+    finally:
+        if previous_parallelism is None:
+            os.environ.pop('TOKENIZERS_PARALLELISM', None)
+        else:
+            os.environ['TOKENIZERS_PARALLELISM'] = previous_parallelism
+    
+    logger.info(f"Loaded {len(dataset)} training examples")
+    return dataset
+
+
+@dataclass(frozen=True)
+class TrainCfg:
+    """Training configuration parsed once from the config JSON"""
+    
+    epochs: int = 10
+    batch_size: int = 8
+    gradient_accumulation_steps: int = 4
+    gradient_checkpointing: bool = True
+    learning_rate: float = 5e-5
+    warmup_steps: int = 500
+    max_length: int = 512
+    logging_steps: int = 100
+    save_steps: int = 1000
+    eval_steps: int = 500
+    save_total_limit: int = 3
+    bf16: bool = True
+    fp16: bool = True
+    optim: Optional[str] = None
+    torch_compile: bool = True
+    length_buckets: Tuple[int, ...] = (64, 128, 256, 512)
+    group_by_length: bool = True
+    num_workers: int = field(default_factory=lambda: min(8, os.cpu_count() or 1))
+    prefetch_factor: int = 4
+    num_proc: Optional[int] = field(default_factory=os.cpu_count)
+    tokenize_batch_size: int = 10000
+    use_safetensors: Optional[bool] = None
+    
+    @classmethod
+    def from_dict(cls, config: dict) -> 'TrainCfg':
+        known = {f.name for f in fields(cls)}
+        unknown = sorted(set(config) - known)
+        if unknown:
+            logger.warning(f"Ignoring unknown config keys: {unknown}")
+        values = {key: value for key, value in config.items() if key in known}
+        if 'length_buckets' in values:
+            # The collator picks the first bucket that fits, so keep them ascending
+            values['length_buckets'] = tuple(sorted(values['length_buckets']))
+        return cls(**values)
+
+
+@dataclass
+class Int32DataCollator(DataCollatorForSeq2Seq):
+    """Seq2seq collator that sends input ids and attention masks as int32
+    
+    Halves their host-to-device traffic; embeddings accept int32 indices.
+    Labels stay int64 because the cross-entropy loss requires it.
+    """
+    
+    def __call__(self, features, return_tensors=None):
+        batch = super().__call__(features, return_tensors)
+        for key in ('input_ids', 'attention_mask'):
+            if isinstance(batch.get(key), torch.Tensor):
+                batch[key] = batch[key].to(torch.int32)
+        return batch
+
+
+@dataclass
+class BucketedDataCollator(Int32DataCollator):
+    """Seq2seq collator that pads every batch up to a fixed length bucket
+    
+    Keeping the set of batch shapes small lets torch.compile capture one CUDA
+    graph per bucket instead of recompiling for every new sequence length.
+    """
+    
+    buckets: Tuple[int, ...] = (64, 128, 256, 512)
+    
+    def _bucket(self, length: int) -> int:
+        return next((bucket for bucket in self.buckets if bucket >= length), length)
+    
+    def _pad(self, ids, length: int, value: int):
+        padding = [value] * (length - len(ids))
+        return padding + ids if self.tokenizer.padding_side == 'left' else ids + padding
+    
+    def __call__(self, features, return_tensors=None):
+        source_length = self._bucket(max(len(feature['input_ids']) for feature in features))
+        target_length = self._bucket(max(len(feature['labels']) for feature in features))
         
-        return {
-            'input_ids': inputs['input_ids'].squeeze(),
-            'attention_mask': inputs['attention_mask'].squeeze(),
-            'labels': targets['input_ids'].squeeze(),
-        }
+        features = [
+            {
+                'input_ids': self._pad(list(feature['input_ids']), source_length, self.tokenizer.pad_token_id),
+                'attention_mask': self._pad(list(feature['attention_mask']), source_length, 0),
+                'labels': self._pad(list(feature['labels']), target_length, self.label_pad_token_id),
+            }
+            for feature in features
+        ]
+        return super().__call__(features, return_tensors)
 
 
 def train_model(
@@ -76,43 +191,108 @@ def train_model(
     """Train a text humanization model"""
     
     logger.info(f"Starting training with config: {config}")
+    cfg = TrainCfg.from_dict(config)
     
     # Load tokenizer and model
     logger.info(f"Loading model: {model_name}")
-    tokenizer = AutoTokenizer.from_pretrained(model_name)
-    model = AutoModelForSeq2SeqLM.from_pretrained(model_name)
+    tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
+    model = AutoModelForSeq2SeqLM.from_pretrained(model_name, use_safetensors=cfg.use_safetensors)
+    
+    # The KV cache is useless while training and breaks graph capture
+    model.config.use_cache = False
+    
+    # Trade recomputation for activation memory
+    if cfg.gradient_checkpointing:
+        model.gradient_checkpointing_enable()
     
     # Create datasets
     logger.info("Loading training data...")
-    train_dataset = HumanizationDataset(train_data_path, tokenizer, config.get('max_length', 512))
+    train_dataset = load_humanization_dataset(
+        train_data_path, tokenizer, cfg.max_length, cfg.num_proc, cfg.tokenize_batch_size
+    )
     
     val_dataset = None
     if val_data_path and os.path.exists(val_data_path):
         logger.info("Loading validation data...")
-        val_dataset = HumanizationDataset(val_data_path, tokenizer, config.get('max_length', 512))
+        val_dataset = load_humanization_dataset(
+            val_data_path, tokenizer, cfg.max_length, cfg.num_proc, cfg.tokenize_batch_size
+        )
+    
+    # Mixed precision: BF16 (with TF32 matmuls) on Ampere+, FP16 on older GPUs
+    # is_bf16_supported() alone also reports emulated bf16 on pre-Ampere GPUs (T4, V100),
+    # where bf16 is slow and TrainingArguments rejects tf32
+    use_cuda = torch.cuda.is_available()
+    is_ampere = use_cuda and torch.cuda.get_device_capability()[0] >= 8
+    use_bf16 = is_ampere and torch.cuda.is_bf16_supported() and cfg.bf16
+    use_fp16 = use_cuda and not use_bf16 and cfg.fp16
+    if use_bf16:
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+    
+    # 8-bit AdamW (bitsandbytes) quantizes optimizer state to free VRAM for larger batches;
+    # otherwise fused AdamW does the whole parameter update in a single kernel. Both are CUDA-only.
+    if cfg.optim:
+        optim_name = cfg.optim
+    elif use_cuda and importlib.util.find_spec('bitsandbytes') is not None:
+        optim_name = 'adamw_bnb_8bit'
+    elif use_cuda:
+        optim_name = 'adamw_torch_fused'
+    else:
+        optim_name = 'adamw_torch'
+    logger.info(f"Using optimizer: {optim_name}")
+    
+    # TorchInductor kernel fusion + CUDA graphs (PyTorch 2.x only)
+    use_compile = use_cuda and hasattr(torch, 'compile') and cfg.torch_compile
     
     # Training arguments
     training_args = TrainingArguments(
         output_dir=output_dir,
-        num_train_epochs=config.get('epochs', 10),
-        per_device_train_batch_size=config.get('batch_size', 8),
-        per_device_eval_batch_size=config.get('batch_size', 8),
-        learning_rate=config.get('learning_rate', 5e-5),
-        warmup_steps=config.get('warmup_steps', 500),
+        num_train_epochs=cfg.epochs,
+        per_device_train_batch_size=cfg.batch_size,
+        per_device_eval_batch_size=cfg.batch_size,
+        gradient_accumulation_steps=cfg.gradient_accumulation_steps,
+        gradient_checkpointing=cfg.gradient_checkpointing,
+        learning_rate=cfg.learning_rate,
+        optim=optim_name,
+        warmup_steps=cfg.warmup_steps,
         logging_dir=f"{output_dir}/logs",
-        logging_steps=config.get('logging_steps', 100),
-        save_steps=config.get('save_steps', 1000),
-        eval_steps=config.get('eval_steps', 500) if val_dataset else None,
+        logging_steps=cfg.logging_steps,
+        save_steps=cfg.save_steps,
+        eval_steps=cfg.eval_steps if val_dataset else None,
         evaluation_strategy='steps' if val_dataset else 'no',
-        save_total_limit=config.get('save_total_limit', 3),
+        group_by_length=cfg.group_by_length,
+        length_column_name='length',
+        save_total_limit=cfg.save_total_limit,
         load_best_model_at_end=True if val_dataset else False,
         metric_for_best_model='loss',
         greater_is_better=False,
-        fp16=config.get('fp16', False),
-        dataloader_num_workers=config.get('num_workers', 4),
+        bf16=use_bf16,
+        bf16_full_eval=use_bf16,
+        fp16=use_fp16,
+        tf32=use_bf16,
+        dataloader_num_workers=cfg.num_workers,
+        dataloader_pin_memory=True,
+        dataloader_persistent_workers=cfg.num_workers > 0,
+        dataloader_prefetch_factor=cfg.prefetch_factor if cfg.num_workers > 0 else None,
+        torch_compile=use_compile,
+        torch_compile_mode='reduce-overhead' if use_compile else None,
+        save_safetensors=True,
         report_to='none',  # Disable wandb/tensorboard for now
     )
     
+    # Pad each batch to its longest sample (rounded up for Tensor Core alignment),
+    # or to a fixed bucket when compiling so CUDA graphs can be replayed
+    collator_args = dict(
+        model=model,
+        padding='longest',
+        pad_to_multiple_of=8,
+        label_pad_token_id=-100,
+    )
+    if use_compile:
+        data_collator = BucketedDataCollator(tokenizer, buckets=cfg.length_buckets, **collator_args)
+    else:
+        data_collator = Int32DataCollator(tokenizer, **collator_args)
+    
     # Trainer
     trainer = Trainer(
         model=model,
@@ -120,16 +300,18 @@ def train_model(
         train_dataset=train_dataset,
         eval_dataset=val_dataset,
         tokenizer=tokenizer,
+        data_collator=data_collator,
     )
     
     # Train
     logger.info("Starting training...")
     train_result = trainer.train()
     
-    # Save final model
+    # Save final model (the Trainer also writes the tokenizer it was given).
+    # Kept synchronous: with bf16_full_eval, evaluate() casts the live weights
+    # to bfloat16 in place, so the save has to finish first anyway.
     logger.info(f"Saving model to {output_dir}")
     trainer.save_model()
-    tokenizer.save_pretrained(output_dir)
     
     # Save training metrics
     metrics = {
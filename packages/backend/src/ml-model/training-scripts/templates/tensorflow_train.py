@@ -6,8 +6,10 @@ Generic template for training text humanization models with TensorFlow/Keras
 
 import argparse
 import json
+import mmap
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 import tensorflow as tf
 from tensorflow import keras
 from tensorflow.keras import layers, optimizers, callbacks
@@ -18,40 +20,237 @@ from pathlib import Path
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# orjson is considerably faster on large corpora; fall back to the stdlib parser
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+START_TOKEN = '[start]'
+END_TOKEN = '[end]'
+
 
 def load_data(data_path: str):
-    """Load training data"""
-    data = []
+    """Load training data from a JSON array or JSONL file"""
+    if os.path.getsize(data_path) == 0:
+        return []
     
-    if data_path.endswith('.json'):
-        with open(data_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-    else:
-        with open(data_path, 'r', encoding='utf-8') as f:
-            data = [json.loads(line) for line in f]
+    with open(data_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if data_path.endswith('.json'):
+            data = json_loads(mm[:])
+        else:
+            data = [json_loads(line) for line in iter(mm.readline, b'') if line.strip()]
     
     logger.info(f"Loaded {len(data)} training examples")
     return data
 
 
+def create_vectorizer(data, vocab_size: int):
+    """Build a whitespace tokenizer over the source and target texts"""
+    vectorizer = layers.TextVectorization(
+        max_tokens=vocab_size,
+        standardize='lower',
+        ragged=True,
+    )
+    texts = [item['input'] for item in data] + [f"{START_TOKEN} {item['output']} {END_TOKEN}" for item in data]
+    vectorizer.adapt(tf.data.Dataset.from_tensor_slices(texts).batch(1024))
+    return vectorizer
+
+
+def make_dataset(
+    data,
+    vectorizer,
+    batch_size: int,
+    max_length: int,
+    length_buckets=(32, 64, 128),
+    training: bool = False,
+):
+    """Build a tf.data pipeline of padded (encoder, decoder) batches with loss weights
+    
+    Texts are vectorized once up front; padded target positions get a sample
+    weight of 0 so they do not contribute to the loss. Batches are padded up to
+    a fixed length bucket so the XLA-compiled step sees only a few shapes.
+    """
+    sources = vectorizer([item['input'] for item in data])[:, :max_length]
+    targets = vectorizer([f"{START_TOKEN} {item['output']} {END_TOKEN}" for item in data])[:, :max_length + 1]
+    buckets = sorted({bucket for bucket in length_buckets if bucket < max_length} | {max_length})
+    
+    def to_example(source, target):
+        decoder_inputs = target[:-1]
+        decoder_targets = target[1:]
+        features = {'encoder_inputs': source, 'decoder_inputs': decoder_inputs}
+        return features, decoder_targets, tf.ones_like(decoder_targets, dtype=tf.float32)
+    
+    def example_length(features, decoder_targets, weights):
+        return tf.maximum(tf.shape(features['encoder_inputs'])[0], tf.shape(decoder_targets)[0])
+    
+    dataset = tf.data.Dataset.from_tensor_slices((sources, targets))
+    dataset = dataset.map(to_example, num_parallel_calls=tf.data.AUTOTUNE)
+    # Cache before shuffling so every epoch reshuffles the full cached set
+    dataset = dataset.cache()
+    if training:
+        dataset = dataset.shuffle(buffer_size=10000, reshuffle_each_iteration=True)
+    # Every sequence is at most max_length long, so each falls into one of the buckets.
+    # Partial batches are kept: each bucket's remainder is the same size every epoch,
+    # so they add at most one extra shape per bucket
+    dataset = dataset.bucket_by_sequence_length(
+        element_length_func=example_length,
+        bucket_boundaries=[bucket + 1 for bucket in buckets],
+        bucket_batch_sizes=[batch_size] * (len(buckets) + 1),
+        pad_to_bucket_boundary=True,
+        drop_remainder=False,
+    )
+    dataset = dataset.prefetch(tf.data.AUTOTUNE)
+    
+    options = tf.data.Options()
+    options.deterministic = False
+    options.threading.private_threadpool_size = os.cpu_count() or 1
+    options.threading.max_intra_op_parallelism = 1
+    return dataset.with_options(options)
+
+
+class AsyncCheckpoint(callbacks.Callback):
+    """Save the best weights each epoch from a background thread
+    
+    Weights are copied into a CPU-side clone of the model on the training
+    thread, and the clone writes a regular Keras ``.weights.h5`` file while the
+    next epoch runs. Restore a checkpoint with ``model.load_weights(path)``.
+    """
+    
+    def __init__(self, filepath: str, monitor: str = 'val_loss'):
+        super().__init__()
+        self.filepath = filepath
+        self.monitor = monitor
+        self.best = np.inf
+        self.snapshot = None
+        self.pool = None
+        self.pending = None
+    
+    def on_train_begin(self, logs=None):
+        self.pool = ThreadPoolExecutor(max_workers=1)
+        if self.snapshot is None:
+            with tf.device('/CPU:0'):
+                self.snapshot = keras.models.clone_model(self.model)
+    
+    def on_epoch_end(self, epoch, logs=None):
+        logs = logs or {}
+        current = logs.get(self.monitor)
+        if current is None or current >= self.best:
+            return
+        
+        self.best = current
+        path = self.filepath.format(epoch=epoch + 1, **logs)
+        # The snapshot is reused, so the previous write must finish before it is overwritten
+        self._wait()
+        self.snapshot.set_weights(self.model.get_weights())
+        self.pending = self.pool.submit(self.snapshot.save_weights, path)
+        logger.info(f"Epoch {epoch + 1}: {self.monitor} improved to {current:.4f}, saving weights to {path}")
+    
+    def on_train_end(self, logs=None):
+        try:
+            self._wait()
+        finally:
+            self.pool.shutdown(wait=True)
+    
+    def _wait(self):
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+
+def supports_bfloat16() -> bool:
+    """Check whether every visible GPU is Ampere (compute capability 8.0) or newer"""
+    gpus = tf.config.list_physical_devices('GPU')
+    if not gpus:
+        return False
+    
+    for gpu in gpus:
+        details = tf.config.experimental.get_device_details(gpu)
+        if details.get('compute_capability', (0, 0)) < (8, 0):
+            return False
+    
+    return True
+
+
+class PositionalEmbedding(layers.Layer):
+    """Token embedding plus a learned position embedding, masking padding (id 0)"""
+    
+    def __init__(self, vocab_size: int, embedding_dim: int, max_length: int, **kwargs):
+        super().__init__(**kwargs)
+        self.vocab_size = vocab_size
+        self.embedding_dim = embedding_dim
+        self.max_length = max_length
+        self.token_embedding = layers.Embedding(vocab_size, embedding_dim)
+        self.position_embedding = layers.Embedding(max_length, embedding_dim)
+    
+    def call(self, inputs):
+        positions = tf.range(tf.shape(inputs)[-1])
+        return self.token_embedding(inputs) + self.position_embedding(positions)
+    
+    def compute_mask(self, inputs, mask=None):
+        return tf.not_equal(inputs, 0)
+    
+    def get_config(self):
+        config = super().get_config()
+        config.update({
+            'vocab_size': self.vocab_size,
+            'embedding_dim': self.embedding_dim,
+            'max_length': self.max_length,
+        })
+        return config
+
+
+def feed_forward(x, embedding_dim: int, hidden_units: int, dropout: float, name: str):
+    """Position-wise feed-forward sublayer with residual connection"""
+    ff = layers.Dense(hidden_units, activation='relu', name=f'{name}_ff_in')(x)
+    ff = layers.Dense(embedding_dim, name=f'{name}_ff_out')(ff)
+    ff = layers.Dropout(dropout)(ff)
+    return layers.LayerNormalization(epsilon=1e-6, name=f'{name}_ff_norm')(layers.Add()([x, ff]))
+
+
 def create_model(vocab_size: int, embedding_dim: int, hidden_units: int, config: dict):
     """Create transformer-based model"""
     
+    num_layers = config.get('num_layers', 2)
+    num_heads = config.get('num_heads', 8)
+    key_dim = embedding_dim // num_heads
+    dropout = config.get('dropout', 0.1)
+    # Decoder inputs are the target shifted by one, so both sides fit in max_length positions
+    max_length = config.get('max_length', 128)
+    
     # Input layers
     encoder_inputs = keras.Input(shape=(None,), name='encoder_inputs')
     decoder_inputs = keras.Input(shape=(None,), name='decoder_inputs')
     
+    # Padding masks propagate from the embeddings into every attention layer
+    
     # Encoder
-    encoder_embedding = layers.Embedding(vocab_size, embedding_dim, mask_zero=True)(encoder_inputs)
-    encoder_outputs = layers.LSTM(hidden_units, return_state=True, name='encoder')(encoder_embedding)
-    encoder_states = encoder_outputs[1:]
+    x = PositionalEmbedding(vocab_size, embedding_dim, max_length, name='encoder_embedding')(encoder_inputs)
+    for i in range(num_layers):
+        name = f'encoder_{i}'
+        attention = layers.MultiHeadAttention(num_heads, key_dim, dropout=dropout, name=f'{name}_self_attention')(x, x)
+        x = layers.LayerNormalization(epsilon=1e-6, name=f'{name}_attention_norm')(layers.Add()([x, attention]))
+        x = feed_forward(x, embedding_dim, hidden_units, dropout, name)
+    encoder_outputs = x
     
     # Decoder
-    decoder_embedding = layers.Embedding(vocab_size, embedding_dim, mask_zero=True)(decoder_inputs)
-    decoder_lstm = layers.LSTM(hidden_units, return_sequences=True, return_state=True, name='decoder')
-    decoder_outputs, _, _ = decoder_lstm(decoder_embedding, initial_state=encoder_states)
-    decoder_dense = layers.Dense(vocab_size, activation='softmax', name='output')
-    outputs = decoder_dense(decoder_outputs)
+    y = PositionalEmbedding(vocab_size, embedding_dim, max_length, name='decoder_embedding')(decoder_inputs)
+    for i in range(num_layers):
+        name = f'decoder_{i}'
+        attention = layers.MultiHeadAttention(num_heads, key_dim, dropout=dropout, name=f'{name}_self_attention')(
+            y, y, use_causal_mask=True
+        )
+        y = layers.LayerNormalization(epsilon=1e-6, name=f'{name}_attention_norm')(layers.Add()([y, attention]))
+        attention = layers.MultiHeadAttention(num_heads, key_dim, dropout=dropout, name=f'{name}_cross_attention')(
+            y, encoder_outputs
+        )
+        y = layers.LayerNormalization(epsilon=1e-6, name=f'{name}_cross_attention_norm')(layers.Add()([y, attention]))
+        y = feed_forward(y, embedding_dim, hidden_units, dropout, name)
+    
+    # Raw logits; the loss applies a fused log-softmax. Kept in float32 to preserve
+    # the logit range under mixed precision.
+    decoder_dense = layers.Dense(vocab_size, dtype='float32', name='output')
+    outputs = decoder_dense(y)
     
     # Model
     model = keras.Model([encoder_inputs, decoder_inputs], outputs)
@@ -68,6 +267,7 @@ def train_model(
     """Train a text humanization model"""
     
     logger.info(f"Starting training with config: {config}")
+    logger.info(f"GPUs available: {tf.config.list_physical_devices('GPU')}")
     
     # Load data
     logger.info("Loading training data...")
@@ -78,14 +278,26 @@ def train_model(
         logger.info("Loading validation data...")
         val_data = load_data(val_data_path)
     
-    # TODO: Implement tokenization and data preprocessing
-    # For now, this is a template structure
+    # Tokenize and batch
+    logger.info("Building vocabulary...")
+    vectorizer = create_vectorizer(train_data, config.get('vocab_size', 10000))
+    vocab_size = vectorizer.vocabulary_size()
+    
+    batch_size = config.get('batch_size', 32)
+    max_length = config.get('max_length', 128)
+    length_buckets = config.get('length_buckets', (32, 64, 128))
+    train_dataset = make_dataset(train_data, vectorizer, batch_size, max_length, length_buckets, training=True)
+    val_dataset = make_dataset(val_data, vectorizer, batch_size, max_length, length_buckets) if val_data else None
     
     # Model configuration
-    vocab_size = config.get('vocab_size', 10000)
     embedding_dim = config.get('embedding_dim', 256)
     hidden_units = config.get('hidden_units', 512)
     
+    # Mixed precision on Ampere+ GPUs
+    if config.get('mixed_precision', True) and supports_bfloat16():
+        logger.info("Enabling mixed_bfloat16 precision policy")
+        keras.mixed_precision.set_global_policy('mixed_bfloat16')
+    
     # Create model
     logger.info("Creating model...")
     model = create_model(vocab_size, embedding_dim, hidden_units, config)
@@ -95,17 +307,19 @@ def train_model(
     optimizer = optimizers.Adam(learning_rate=learning_rate)
     model.compile(
         optimizer=optimizer,
-        loss='sparse_categorical_crossentropy',
-        metrics=['accuracy']
+        loss=keras.losses.SparseCategoricalCrossentropy(from_logits=True),
+        metrics=['accuracy'],
+        jit_compile=config.get('jit_compile', True),
     )
     
     # Callbacks
+    checkpoint_dir = os.path.join(output_dir, 'checkpoints')
+    os.makedirs(checkpoint_dir, exist_ok=True)
     callbacks_list = [
-        callbacks.ModelCheckpoint(
-            filepath=os.path.join(output_dir, 'checkpoints', 'checkpoint-{epoch:02d}-{val_loss:.2f}.h5'),
+        # Weights only, written off the training thread
+        AsyncCheckpoint(
+            filepath=os.path.join(checkpoint_dir, 'checkpoint-{epoch:02d}-{val_loss:.2f}.weights.h5'),
             monitor='val_loss',
-            save_best_only=True,
-            verbose=1,
         ),
         callbacks.EarlyStopping(
             monitor='val_loss',
@@ -120,16 +334,12 @@ def train_model(
         ),
     ]
     
-    # Prepare data
-    # TODO: Implement data preprocessing and batching
-    
     # Train
     logger.info("Starting training...")
     history = model.fit(
-        # train_data_preprocessed,
-        # validation_data=val_data_preprocessed if val_data else None,
+        train_dataset,
+        validation_data=val_dataset,
         epochs=config.get('epochs', 10),
-        batch_size=config.get('batch_size', 32),
         callbacks=callbacks_list,
         verbose=1,
     )
@@ -137,6 +347,8 @@ def train_model(
     # Save model
     logger.info(f"Saving model to {output_dir}")
     model.save(os.path.join(output_dir, 'model'))
+    with open(os.path.join(output_dir, 'vocab.txt'), 'w', encoding='utf-8') as f:
+        f.write('\n'.join(vectorizer.get_vocabulary()))
     
     # Save training metrics
     metrics = {